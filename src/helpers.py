@@ -1,4 +1,5 @@
 from io import BytesIO
+import re
 from typing import Optional
 
 from lxml import etree
@@ -22,6 +23,17 @@ FILENAME_BANNED_CHAR_RANGES = (
     (ord("\U00100000"), ord("\U0010ffff")),  # Supplementary Private Use Area-B
 )
 
+FILENAME_BANNED_CHARS_RE = re.compile(
+    "[%s%s]"
+    % (
+        re.escape(FILENAME_BANNED_CHARS),
+        "".join(
+            "\\U%08x-\\U%08x" % (range_bottom, range_top)
+            for range_bottom, range_top in FILENAME_BANNED_CHAR_RANGES
+        ),
+    )
+)
+
 
 ###################
 ##   Functions   ##
@@ -66,26 +78,8 @@ def process_image_for_epub3(source_image: bytes) -> Optional[tuple[bytes, str, s
 
 
 def make_filename_valid_for_epub3(filename: str) -> str:
-    filtered_filename = ""
-
-    # Ensure filename contains only allowed chars
-    for char in filename:
-        if char in FILENAME_BANNED_CHARS:
-            continue
-
-        char_allowed = True
-        for range_bottom, range_top in FILENAME_BANNED_CHAR_RANGES:
-            char_ord = ord(char)
-            if char_ord >= range_bottom and char_ord <= range_top:
-                char_allowed = False
-                break
-
-        if char_allowed:
-            filtered_filename += char
-
-    # Ensure filename doesn't end in '.'
-    while len(filtered_filename) > 0 and filtered_filename[-1] == ".":
-        filtered_filename = filtered_filename[:-1]
+    # Ensure filename contains only allowed chars and doesn't end in '.'
+    filtered_filename = FILENAME_BANNED_CHARS_RE.sub("", filename).rstrip(".")
 
     if len(filtered_filename) == 0:
         raise ValueError(
@@ -1,5 +1,7 @@
 import argparse
-from collections import OrderedDict
+import asyncio
+from http.cookies import SimpleCookie
+from io import BytesIO
 import os
 
 import aiohttp
@@ -41,8 +43,8 @@ def get_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def get_cookies() -> dict[str, str]:
-    cookies = {}
+def get_cookies() -> SimpleCookie:
+    cookies = SimpleCookie()
 
     if os.path.exists("cookie"):
         with open("cookie", "r") as fin:
@@ -53,6 +55,10 @@ def get_cookies() -> dict[str, str]:
                     'cookie file must start with "%s=" (no quotes)' % COOKIE_NAME
                 )
             cookies[COOKIE_NAME] = cookie.strip()
+            # Scope the cookie to Glowfic (and its subdomains), so it isn't
+            # sent along with image requests
+            cookies[COOKIE_NAME]["domain"] = "glowfic.com"
+            cookies[COOKIE_NAME]["path"] = "/"
 
     return cookies
 
@@ -61,56 +67,69 @@ async def main():
     args = get_args()
     cookies = get_cookies()
 
+    # Glowfic requests go one at a time and at most once per second; image
+    # requests share the session's connection pool but skip those limits
     limiter = aiolimiter.AsyncLimiter(1, 1)
+    semaphore = asyncio.Semaphore(1)
     async with aiohttp.ClientSession(
-        connector=aiohttp.TCPConnector(limit_per_host=1), cookies=cookies
-    ) as slow_session:
-        async with aiohttp.ClientSession() as fast_session:
-            spec = await get_post_urls_and_title(slow_session, limiter, args.url)
-            print("Found %i chapters" % len(spec.stamped_urls))
-
-            book = epub.EpubBook()
-            image_map = ImageMap()
-            authors = OrderedDict()
-
-            downloaded_chapters = await download_chapters(
-                slow_session,
-                limiter,
-                fast_session,
-                spec.stamped_urls,
-                image_map,
-                authors,
-            )
-            chapters = list(compile_chapters(downloaded_chapters))
-            for chapter in chapters:
-                for section in chapter:
-                    book.add_item(section)
-            book.set_title(spec.title)
-
-            style = epub.EpubItem(
-                uid="style",
-                file_name="style.css",
-                media_type="text/css",
-                content=stylesheet,
-            )
-            book.add_item(style)
-
-            images = get_images_as_epub_items(image_map)
-
-            for image in images:
-                book.add_item(image)
-
-            for author in authors.keys():
-                book.add_author(author)
-
-            book.toc = [chapter[0] for chapter in chapters]
-            book.add_item(epub.EpubNcx())
-            book.add_item(epub.EpubNav())
-
-            book.spine = ["nav"] + [
-                section for chapter in chapters for section in chapter
-            ]
-
-            out_path = "%s.epub" % spec.title
-            print("Saving book to %s" % out_path)
-            epub.write_epub(out_path, book, {})
+        connector=aiohttp.TCPConnector(limit=64, limit_per_host=16)
+    ) as session:
+        session.cookie_jar.update_cookies(cookies)
+
+        spec = await get_post_urls_and_title(session, limiter, semaphore, args.url)
+        print("Found %i chapters" % len(spec.stamped_urls))
+
+        book = epub.EpubBook()
+        image_map = ImageMap()
+        authors: dict[str, None] = {}
+
+        downloaded_chapters = await download_chapters(
+            session,
+            limiter,
+            semaphore,
+            spec.stamped_urls,
+            image_map,
+            authors,
+        )
+        chapters = compile_chapters(downloaded_chapters)
+        sections = [section for chapter in chapters for section in chapter]
+        for section in sections:
+            book.add_item(section)
+        book.set_title(spec.title)
+
+        style = epub.EpubItem(
+            uid="style",
+            file_name="style.css",
+            media_type="text/css",
+            content=stylesheet,
+        )
+        book.add_item(style)
+
+        images = get_images_as_epub_items(image_map)
+
+        for image in images:
+            book.add_item(image)
+
+        for author in authors:
+            book.add_author(author)
+
+        book.toc = [chapter[0] for chapter in chapters]
+        book.add_item(epub.EpubNcx())
+        nav = epub.EpubNav()
+        book.add_item(nav)
+
+        # Passing the nav item itself saves a by-ID lookup when writing
+        book.spine = [nav] + sections
+
+        out_path = "%s.epub" % spec.title
+        print("Saving book to %s" % out_path)
+        # Build the zip in memory, then write it out in one go
+        out_buffer = BytesIO()
+        # Older ebooklib returns None whatever happens; newer returns False on
+        # an OSError rather than raising it
+        if epub.write_epub(out_buffer, book, {}) is False:
+            raise RuntimeError("Failed to build EPUB for %s" % out_path)
+        with open(out_path, "wb") as fout:
+            fout.write(out_buffer.getbuffer())
+            fout.flush()
+            os.fsync(fout.fileno())
@@ -1,5 +1,4 @@
 import asyncio
-from collections import OrderedDict
 from datetime import datetime, timezone
 import re
 from typing import Iterable, Optional
@@ -9,7 +8,7 @@ from zoneinfo import ZoneInfo
 import aiohttp
 import aiolimiter
 from bs4 import BeautifulSoup
-from bs4.element import Tag, ResultSet
+from bs4.element import Tag
 from ebooklib import epub
 from lxml import etree
 from tqdm.asyncio import tqdm
@@ -24,10 +23,43 @@ from .helpers import *
 
 SECTION_SIZE_LIMIT = 200000
 
+IMAGE_DOWNLOAD_ATTEMPTS = 3
+IMAGE_DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=15, connect=5)
+
 RELATIVE_REPLY_RE = re.compile(r"/(replies|posts)/\d*")
 ABSOLUTE_REPLY_RE = re.compile(
     r"https?://(www.)?glowfic.com(?P<relative>/(replies|posts)/\d*)"
 )
+# Cheap stand-ins for urlparse: the fragment, and whether there's a netloc.
+# urlparse ignores leading whitespace and control chars, so strip those before
+# checking for a netloc.
+FRAGMENT_RE = re.compile(r"#(.*)", re.DOTALL)
+HAS_NETLOC_RE = re.compile(r"([a-zA-Z][a-zA-Z0-9+.-]*:)?//[^/?#]")
+URL_LEADING_JUNK = "".join(map(chr, range(0x21)))
+
+CHAPTER_CHUNK_SIZE = 65536
+
+# XPath predicate for elements whose class list includes the given class
+HAS_CLASS = "contains(concat(' ', normalize-space(@class), ' '), ' %s ')"
+
+TEXT_XPATH = etree.XPath("string()", smart_strings=False)
+TITLE_XPATH = etree.XPath(".//span[@id='post-title']")
+FLASH_ERROR_XPATH = etree.XPath(
+    ".//div[%s and %s]" % (HAS_CLASS % "flash", HAS_CLASS % "error")
+)
+POST_CONTAINER_XPATH = etree.XPath(".//div[%s]" % (HAS_CLASS % "post-container"))
+POST_FIELD_CLASSES = (
+    "post-character",
+    "post-screenname",
+    "post-author",
+    "post-content",
+)
+POST_FIELDS_XPATH = etree.XPath(
+    ".//div[%s]" % " or ".join(HAS_CLASS % class_ for class_ in POST_FIELD_CLASSES)
+)
+POST_CONTENT_XPATH = etree.XPath(".//div[%s]" % (HAS_CLASS % "post-content"))
+ICON_XPATH = etree.XPath(".//img[%s]" % (HAS_CLASS % "icon"))
+PERMALINK_XPATH = etree.XPath(".//img[@title='Permalink' and @alt='Permalink']/..")
 
 GLOWFIC_ROOT = "https://glowfic.com"
 GLOWFIC_TZ = ZoneInfo("America/New_York")
@@ -53,18 +85,6 @@ div.post {
 }
 """.lstrip()
 
-output_template = """
-<html>
-<head>
-</head>
-<body>
-<div class="posts">
-</div>
-</body>
-</html>
-""".lstrip()
-
-
 #################
 ##   Classes   ##
 #################
@@ -79,6 +99,7 @@ class MappedImage:
         self.file = None
         self.media_type = None
         self.ext = None
+        self.filename = None
 
     def add_file(self, file: Optional[bytes], url: str):
         self.downloaded = True
@@ -93,57 +114,83 @@ class MappedImage:
         else:
             self.file, self.media_type, self.ext = processed
 
-    def get_filename(self, id_width: int) -> Optional[str]:
+    def set_filename(self, id_width: int):
+        if self.downloaded and not self.is_null:
+            self.filename = "Images/%s%.*i.%s" % (
+                self.name,
+                id_width,
+                self.id,
+                self.ext,
+            )
+
+    def get_filename(self) -> Optional[str]:
         if not self.downloaded:
             raise RuntimeError(
                 "Attempted to get mapped image filename before getting it as a file. (This indicates a prior map population failure.)"
             )
         elif self.is_null:
             return None
+        elif self.filename is None:
+            raise RuntimeError(
+                "Attempted to get mapped image filename before assigning filenames."
+            )
         else:
-            return "Images/%s%.*i.%s" % (self.name, id_width, self.id, self.ext)
+            return self.filename
 
 
 class ImageMap:
     def __init__(self):
         self.map = {}
         self.next_icon = 0
-        self.icon_id_width = 1
         self.next_image = 0
-        self.image_id_width = 1
 
     def add_icon(self, url: str):
         if url not in self.map:
             self.map[url] = MappedImage("icon", self.next_icon)
-            self.icon_id_width = len(str(self.next_icon))
             self.next_icon += 1
 
     def add_image(self, url: str):
         if url not in self.map:
             self.map[url] = MappedImage("image", self.next_image)
-            self.image_id_width = len(str(self.next_image))
             self.next_image += 1
 
+    def assign_filenames(self):
+        # Only done once the map is fully populated, so all IDs of a kind are
+        # padded to the same width
+        icon_id_width = len(str(self.next_icon - 1))
+        image_id_width = len(str(self.next_image - 1))
+        for mapped_image in self.map.values():
+            if mapped_image.name == "icon":
+                mapped_image.set_filename(icon_id_width)
+            else:
+                mapped_image.set_filename(image_id_width)
+
     def get_icon_name(self, url: str) -> Optional[str]:
         if url not in self.map:
             raise ValueError(
                 "Attempted to get icon not in image map. (This indicates a prior map population failure.)"
             )
-        return self.map[url].get_filename(self.icon_id_width)
+        return self.map[url].get_filename()
 
     def get_image_name(self, url: str) -> Optional[str]:
         if url not in self.map:
             raise ValueError(
                 "Attempted to get image not in image map. (This indicates a prior map population failure.)"
             )
-        return self.map[url].get_filename(self.image_id_width)
+        return self.map[url].get_filename()
 
 
 class RenderedPost:
     def __init__(
-        self, html: BeautifulSoup, author: str, permalink: str, permalink_fragment: str
+        self,
+        html: etree._Element,
+        size: int,
+        author: str,
+        permalink: str,
+        permalink_fragment: str,
     ):
         self.html = html
+        self.size = size
         self.author = author
         self.permalink = permalink
         self.permalink_fragment = permalink_fragment
@@ -151,14 +198,17 @@ class RenderedPost:
 
 class Section:
     def __init__(self):
-        self.html = BeautifulSoup(output_template, "html.parser")
-        self.body = self.html.find("div")
+        self.html = etree.Element("html")
+        etree.SubElement(self.html, "head")
+        self.body = etree.SubElement(
+            etree.SubElement(self.html, "body"), "div", {"class": "posts"}
+        )
         self.size = 0
         self.link_targets = []
+        self.file_name = None
 
     def append(self, post: RenderedPost):
-        post_size = len(post.html.encode())
-        self.size += post_size
+        self.size += post.size
         self.body.append(post.html)
         self.link_targets.append(post.permalink)
 
@@ -181,79 +231,99 @@ class BookSpec:
 ###################
 
 
-def populate_image_map(posts: ResultSet, image_map: ImageMap):
+def populate_image_map(posts: list[etree._Element], image_map: ImageMap):
     # Find icons
     for post in posts:
-        icon = post.find("img", "icon")
-        if icon:
-            image_map.add_icon(icon["src"])
+        icons = ICON_XPATH(post)
+        if icons:
+            image_map.add_icon(icons[0].get("src"))
 
     # Find non-icon images
     for post in posts:
-        for image in post.find("div", "post-content").find_all("img"):
-            image_map.add_image(image["src"])
+        for image in POST_CONTENT_XPATH(post)[0].iter("img"):
+            image_map.add_image(image.get("src"))
 
 
 async def download_image(
     session: aiohttp.ClientSession, url: str, mapped_image: MappedImage
 ):
-    try:
-        async with session.get(url, timeout=15) as resp:
-            file = await resp.read()
-    except (aiohttp.ClientError, asyncio.TimeoutError):
+    file = None
+    for attempt in range(IMAGE_DOWNLOAD_ATTEMPTS):
+        try:
+            async with session.get(url, timeout=IMAGE_DOWNLOAD_TIMEOUT) as resp:
+                file = await resp.read()
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt + 1 < IMAGE_DOWNLOAD_ATTEMPTS:
+                await asyncio.sleep(2**attempt)  # Back off before retrying
+    else:
         print("Failed to download %s" % url)
-        file = None
     mapped_image.add_file(file, url)
 
 
-def render_post(post: Tag, image_map: ImageMap) -> RenderedPost:
-    try:
-        character = post.find("div", "post-character").text.strip()
-    except AttributeError:
-        character = None
-    try:
-        screen_name = post.find("div", "post-screenname").text.strip()
-    except AttributeError:
-        screen_name = None
-    try:
-        author = post.find("div", "post-author").text.strip()
-    except AttributeError:
-        author = None
-    content = post.find("div", "post-content")
-    header = BeautifulSoup("<p><strong></strong></p>", "html.parser")
-    header.find("strong").string = " / ".join(
-        [x for x in [character, screen_name, author] if x is not None]
+def find_post_fields(post: etree._Element) -> dict[str, etree._Element]:
+    # One query for all of a post's fields, rather than a tree walk for each
+    fields = {}
+    for div in POST_FIELDS_XPATH(post):
+        for class_ in div.get("class").split():
+            if class_ in POST_FIELD_CLASSES:
+                fields.setdefault(class_, div)
+    return fields
+
+
+def element_text(element: Optional[etree._Element]) -> Optional[str]:
+    return TEXT_XPATH(element).strip() if element is not None else None
+
+
+def render_post(post: etree._Element, image_map: ImageMap) -> RenderedPost:
+    fields = find_post_fields(post)
+    character = element_text(fields.get("post-character"))
+    screen_name = element_text(fields.get("post-screenname"))
+    author = element_text(fields.get("post-author"))
+    content = fields["post-content"]
+    header = etree.Element("p")
+    etree.SubElement(header, "strong").text = " / ".join(
+        filter(None, (character, screen_name, author))
     )
 
-    for inline_img in content.find_all("img"):
-        mapped_image = image_map.get_image_name(inline_img["src"])
+    for inline_img in content.iter("img"):
+        mapped_image = image_map.get_image_name(inline_img.get("src"))
         if mapped_image is not None:
-            inline_img["src"] = "../%s" % mapped_image
+            inline_img.set("src", "../%s" % mapped_image)
         else:
-            inline_img["src"] = "data:,"
+            inline_img.set("src", "data:,")
 
-    post_html = BeautifulSoup('<div class="post"></div>', "html.parser")
-    post_div = post_html.find("div")
-    permalink = post.find("img", title="Permalink", alt="Permalink").parent["href"]
-    permalink_fragment = urlparse(permalink).fragment
+    post_div = etree.Element("div", {"class": "post"})
+    permalink = PERMALINK_XPATH(post)[0].get("href")
+    fragment = FRAGMENT_RE.search(permalink)
+    permalink_fragment = fragment.group(1) if fragment is not None else ""
     if permalink_fragment != "":
-        reply_anchor = post_html.new_tag("a", id=permalink_fragment)
-        post_div.extend([reply_anchor])  # for linking to this reply
+        # for linking to this reply
+        etree.SubElement(post_div, "a", id=permalink_fragment)
 
-    icon = post.find("img", "icon")
-    if icon:
-        mapped_icon = image_map.get_icon_name(icon["src"])
+    icons = ICON_XPATH(post)
+    if icons:
+        mapped_icon = image_map.get_icon_name(icons[0].get("src"))
         if mapped_icon:
-            local_image = BeautifulSoup('<img class="icon"></img>', "html.parser")
-            local_image.find("img")["src"] = "../%s" % mapped_icon
-            local_image.find("img")["alt"] = icon["alt"]
-            post_div.extend([header, local_image] + content.contents)
+            local_image = etree.Element(
+                "img",
+                {
+                    "class": "icon",
+                    "src": "../%s" % mapped_icon,
+                    "alt": icons[0].get("alt", ""),
+                },
+            )
+            post_div.extend([header, local_image])
         else:
-            post_div.extend([header] + content.contents)
+            post_div.append(header)
     else:
-        post_div.extend([header] + content.contents)
+        post_div.append(header)
+    # lxml holds text preceding the first child on the parent, not as a node
+    post_div[-1].tail = content.text
+    post_div.extend(list(content))
     return RenderedPost(
-        html=post_html,
+        html=post_div,
+        size=len(etree.tostring(post_div, encoding="utf-8")),
         author=author,
         permalink=permalink,
         permalink_fragment=permalink_fragment,
@@ -261,70 +331,124 @@ def render_post(post: Tag, image_map: ImageMap) -> RenderedPost:
 
 
 def render_posts(
-    posts: ResultSet, image_map: ImageMap, authors: OrderedDict
+    posts: list[etree._Element], image_map: ImageMap, authors: dict[str, None]
 ) -> Iterable[Section]:
     out = Section()
     for post in posts:
         rendered = render_post(post, image_map)
-        post_size = len(rendered.html.encode())
-        if out.size + post_size > SECTION_SIZE_LIMIT and out.size > 0:
+        if out.size + rendered.size > SECTION_SIZE_LIMIT and out.size > 0:
             yield out
             out = Section()
         out.append(rendered)
-        authors[rendered.author] = True
+        authors[rendered.author] = None
     yield out
 
 
 async def download_chapter(
     session: aiohttp.ClientSession,
     limiter: aiolimiter.AsyncLimiter,
+    semaphore: asyncio.Semaphore,
     stamped_url: StampedURL,
-) -> BeautifulSoup:
+) -> tuple[str, list[etree._Element]]:
     await limiter.acquire()
-    resp = await session.get(stamped_url.url, params={"view": "flat"})
-    soup = BeautifulSoup(await resp.text(), "html.parser")
-    resp.close()
-    return soup
+    async with semaphore:
+        async with session.get(stamped_url.url, params={"view": "flat"}) as resp:
+            # Parse as the page arrives, rather than after buffering all of it
+            parser = etree.HTMLParser(encoding=resp.charset or "utf-8")
+            async for chunk in resp.content.iter_chunked(CHAPTER_CHUNK_SIZE):
+                parser.feed(chunk)
+    root = parser.close()
+    title = TEXT_XPATH(validate_element(TITLE_XPATH(root), root)).strip()
+
+    # Move the posts into a document of their own, so the rest of the page can
+    # be freed now rather than staying resident until every chapter is in
+    posts = etree.Element("div")
+    posts.extend(POST_CONTAINER_XPATH(root))
+    return title, list(posts)
 
 
 async def download_chapters(
-    slow_session: aiohttp.ClientSession,
+    session: aiohttp.ClientSession,
     limiter: aiolimiter.AsyncLimiter,
-    fast_session: aiohttp.ClientSession,
+    semaphore: asyncio.Semaphore,
     stamped_urls: list[StampedURL],
     image_map: ImageMap,
-    authors: OrderedDict,
+    authors: dict[str, None],
 ) -> list[tuple[str, list[Section]]]:
     print("Downloading chapter texts")
-    chapter_soups = await tqdm.gather(
+    chapters = await tqdm.gather(
         *[
-            download_chapter(slow_session, limiter, stamped_url)
+            download_chapter(session, limiter, semaphore, stamped_url)
             for stamped_url in stamped_urls
         ]
     )
-    for chapter_soup in chapter_soups:
-        posts = chapter_soup.find_all("div", "post-container")
+    for (_, posts) in chapters:
         populate_image_map(posts, image_map)
     print("Downloading images")
     await tqdm.gather(
         *[
-            download_image(fast_session, url, mapped_image)
+            download_image(session, url, mapped_image)
             for (url, mapped_image) in image_map.map.items()
         ]
     )
+    image_map.assign_filenames()
     rendered_chapters = []
-    for chapter_soup in chapter_soups:
-        title = validate_tag(
-            chapter_soup.find("span", id="post-title"), chapter_soup
-        ).text.strip()
-        posts = chapter_soup.find_all("div", "post-container")
+    for (title, posts) in chapters:
         rendered_chapters.append((title, list(render_posts(posts, image_map, authors))))
     return rendered_chapters
 
 
+def compile_chapter(
+    title: str, sections: list[Section], anchor_sections: dict[str, str]
+) -> list[epub.EpubHtml]:
+    # Replace external links with internal links where possible
+    for section in sections:
+        for a in section.html.iter("a"):
+            raw_url = a.get("href")
+            if raw_url is None:
+                continue
+            if RELATIVE_REPLY_RE.match(raw_url) and raw_url in anchor_sections:
+                url = urlparse(raw_url)
+                a.set("href", url._replace(path=anchor_sections[raw_url]).geturl())
+                continue
+
+            abs = ABSOLUTE_REPLY_RE.match(raw_url)
+            if abs is not None and abs.group("relative") in anchor_sections:
+                a.set("href", anchor_sections[abs.group("relative")])
+                continue
+
+            # Absolute link; leave it be
+            if HAS_NETLOC_RE.match(raw_url.lstrip(URL_LEADING_JUNK)):
+                continue
+
+            url = urlparse(raw_url)
+            if url.netloc == "":  # Relative link to something not included here
+                a.set(
+                    "href",
+                    url._replace(scheme="https", netloc="glowfic.com").geturl(),
+                )
+
+    # Build one EpubHTML object per section
+    compiled_sections = []
+    for section in sections:
+        compiled_section = epub.EpubHtml(
+            title=title,
+            file_name="Text/" + section.file_name,
+            media_type="application/xhtml+xml",
+        )
+        compiled_section.content = etree.tostring(
+            section.html, encoding="unicode", pretty_print=True
+        )
+        compiled_section.add_link(
+            href="../style.css", rel="stylesheet", type="text/css"
+        )
+        compiled_sections.append(compiled_section)
+    return compiled_sections
+
+
 def compile_chapters(
     chapters: list[tuple[str, list[Section]]]
-) -> Iterable[list[epub.EpubHtml]]:
+) -> list[list[epub.EpubHtml]]:
     chapter_digits = len(str(len(chapters)))
     anchor_sections = {}
 
@@ -332,7 +456,7 @@ def compile_chapters(
     for (i, (title, sections)) in enumerate(chapters):
         section_digits = len(str(len(sections) - 1))
         for (j, section) in enumerate(sections):
-            file_name = make_filename_valid_for_epub3(
+            section.file_name = make_filename_valid_for_epub3(
                 "%.*i-%.*i (%s).xhtml"
                 % (
                     chapter_digits,
@@ -343,59 +467,12 @@ def compile_chapters(
                 )
             )
             for permalink in section.link_targets:
-                anchor_sections[permalink] = file_name
+                anchor_sections[permalink] = section.file_name
 
-    # Replace external links with internal links where possible
-    for (i, (title, sections)) in enumerate(chapters):
-        for (j, section) in enumerate(sections):
-            for a in section.html.find_all("a"):
-                if "href" not in a.attrs:
-                    continue
-                raw_url = a["href"]
-                url = urlparse(raw_url)
-                if RELATIVE_REPLY_RE.match(raw_url) and raw_url in anchor_sections:
-                    a["href"] = url._replace(path=anchor_sections[raw_url]).geturl()
-                else:
-                    abs = ABSOLUTE_REPLY_RE.match(raw_url)
-                    if abs is not None and abs.group("relative") in anchor_sections:
-                        a["href"] = anchor_sections[abs.group("relative")]
-                    elif (
-                        url.netloc == ""
-                    ):  # Relative link to something not included here
-                        a["href"] = url._replace(
-                            scheme="https", netloc="glowfic.com"
-                        ).geturl()
-
-    # Yield one list of EpubHTML objects per chapter
-    for (i, (title, sections)) in enumerate(chapters):
-        section_digits = len(str(len(sections) - 1))
-        compiled_sections = []
-        for (j, section) in enumerate(sections):
-            file_name = "Text/" + make_filename_valid_for_epub3(
-                "%.*i-%.*i (%s).xhtml"
-                % (
-                    chapter_digits,
-                    i + 1,
-                    section_digits,
-                    j,
-                    title,
-                )
-            )
-            compiled_section = epub.EpubHtml(
-                title=title, file_name=file_name, media_type="application/xhtml+xml"
-            )
-            compiled_section.content = etree.tostring(
-                etree.fromstring(
-                    str(section.html), etree.XMLParser(remove_blank_text=True)
-                ),
-                encoding="unicode",
-                pretty_print=True,
-            )
-            compiled_section.add_link(
-                href="../style.css", rel="stylesheet", type="text/css"
-            )
-            compiled_sections.append(compiled_section)
-        yield compiled_sections
+    return [
+        compile_chapter(title, sections, anchor_sections)
+        for (title, sections) in chapters
+    ]
 
 
 def validate_tag(tag: Tag, soup: BeautifulSoup) -> Tag:
@@ -408,6 +485,18 @@ def validate_tag(tag: Tag, soup: BeautifulSoup) -> Tag:
         raise RuntimeError("Unknown error: tag missing")
 
 
+def validate_element(
+    found: list[etree._Element], root: etree._Element
+) -> etree._Element:
+    if found:
+        return found[0]
+    errs = FLASH_ERROR_XPATH(root)
+    if errs:
+        raise RuntimeError(TEXT_XPATH(errs[0]).strip())
+    else:
+        raise RuntimeError("Unknown error: element missing")
+
+
 def stamped_url_from_board_row(row: Tag) -> StampedURL:
     url = urljoin(GLOWFIC_ROOT, row.find("a")["href"])
     ts_raw = (
@@ -421,13 +510,16 @@ def stamped_url_from_board_row(row: Tag) -> StampedURL:
 
 
 async def get_post_urls_and_title(
-    session: aiohttp.ClientSession, limiter: aiolimiter.AsyncLimiter, url: str
+    session: aiohttp.ClientSession,
+    limiter: aiolimiter.AsyncLimiter,
+    semaphore: asyncio.Semaphore,
+    url: str,
 ) -> BookSpec:
     if "posts" in url:
         api_url = "https://glowfic.com/api/v1%s" % urlparse(url).path
         await limiter.acquire()
-        resp = await session.get(api_url)
-        post_json = await resp.json()
+        async with semaphore, session.get(api_url) as resp:
+            post_json = await resp.json()
         ts = datetime.strptime(post_json["tagged_at"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(
             tzinfo=timezone.utc
         )
@@ -435,8 +527,8 @@ async def get_post_urls_and_title(
         return BookSpec(stamped_urls=[StampedURL(url, ts)], title=title)
     if "board_sections" in url or "boards" in url:
         await limiter.acquire()
-        resp = await session.get(url)
-        soup = BeautifulSoup(await resp.text(), "html.parser")
+        async with semaphore, session.get(url) as resp:
+            soup = BeautifulSoup(await resp.text(), "lxml")
         rows = validate_tag(soup.find("div", id="content"), soup).find_all(
             "td", "post-subject"
         )
@@ -1,6 +1,33 @@
+from io import BytesIO
 from typing import Optional
 
+from lxml import etree
+from PIL import Image
+import pytest
+
 from src.helpers import make_filename_valid_for_epub3
+from src.render import (
+    ImageMap,
+    Section,
+    compile_chapter,
+    populate_image_map,
+    render_post,
+)
+
+
+#################
+##   Helpers   ##
+#################
+
+
+def make_png() -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", (1, 1)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def parse_post(html: str) -> etree._Element:
+    return etree.fromstring(html, etree.HTMLParser()).find(".//div")
 
 
 ###############
@@ -69,3 +96,112 @@ class TestFilenameValidation:
     def test_long_extension_filename(self):
         filename = "chapter_03." + ("B" * 300)
         self.run(filename, should_error=True)
+
+
+class TestLinkRewriting:
+    def run(self, in_href: str, expected_out_href: str):
+        section = Section()
+        section.file_name = "1-0 (Chapter).xhtml"
+        etree.SubElement(section.body, "a", href=in_href)
+        compile_chapter(
+            "Chapter", [section], {"/replies/456#reply-456": "2-0 (Chapter).xhtml"}
+        )
+        assert section.body[0].get("href") == expected_out_href
+
+    # Links which should be rewritten
+
+    def test_relative_reply_link(self):
+        self.run("/replies/456#reply-456", "2-0 (Chapter).xhtml#reply-456")
+
+    def test_relative_link_to_glowfic(self):
+        self.run("/characters/9", "https://glowfic.com/characters/9")
+
+    # Links which should emerge unscathed
+
+    def test_absolute_link(self):
+        href = "https://www.example.com/page"
+        self.run(href, href)
+
+    def test_absolute_link_with_leading_space(self):
+        href = " https://www.example.com/page"
+        self.run(href, href)
+
+    def test_absolute_link_with_leading_newline(self):
+        href = "\nhttps://imgur.com/a"
+        self.run(href, href)
+
+
+class TestImageMap:
+    def test_icon_filenames_padded_to_final_width(self):
+        image_map = ImageMap()
+        urls = ["https://example.com/icon%i.png" % i for i in range(11)]
+        png = make_png()
+        for url in urls:
+            image_map.add_icon(url)
+        for url in urls:
+            image_map.map[url].add_file(png, url)
+        image_map.assign_filenames()
+
+        assert [image_map.get_icon_name(url) for url in urls] == [
+            "Images/icon%02i.png" % i for i in range(11)
+        ]
+
+    def test_lookup_before_assigning_filenames(self):
+        image_map = ImageMap()
+        url = "https://example.com/icon.png"
+        image_map.add_icon(url)
+        image_map.map[url].add_file(make_png(), url)
+
+        with pytest.raises(RuntimeError):
+            image_map.get_icon_name(url)
+
+
+class TestRenderPost:
+    def render(self, html: str):
+        post = parse_post(html)
+        image_map = ImageMap()
+        populate_image_map([post], image_map)
+        png = make_png()
+        for url, mapped_image in image_map.map.items():
+            mapped_image.add_file(png, url)
+        image_map.assign_filenames()
+        return render_post(post, image_map)
+
+    def test_full_post(self):
+        rendered = self.render(
+            '<div class="post-container post-reply">'
+            '<img class="icon" src="https://example.com/icon.png" alt="An icon">'
+            '<div class="post-character"> Char </div>'
+            '<div class="post-screenname"> screen </div>'
+            '<div class="post-author"><a href="/users/1">Author</a></div>'
+            '<a href="/replies/456#reply-456">'
+            '<img title="Permalink" alt="Permalink" src="/link.png"></a>'
+            '<div class="post-content">Lead <img src="https://example.com/a.png">'
+            " <sup>1</sup> <p>Text</p> tail</div>"
+            "</div>"
+        )
+        assert rendered.author == "Author"
+        assert rendered.permalink == "/replies/456#reply-456"
+        assert rendered.permalink_fragment == "reply-456"
+        assert etree.tostring(rendered.html, encoding="unicode") == (
+            '<div class="post"><a id="reply-456"/>'
+            "<p><strong>Char / screen / Author</strong></p>"
+            '<img class="icon" src="../Images/icon0.png" alt="An icon"/>'
+            'Lead <img src="../Images/image0.png"/> <sup>1</sup> <p>Text</p> tail'
+            "</div>"
+        )
+        assert rendered.size == len(etree.tostring(rendered.html, encoding="utf-8"))
+
+    def test_post_missing_fields(self):
+        rendered = self.render(
+            '<div class="post-container">'
+            '<div class="post-author">Author</div>'
+            '<div class="post-screenname"></div>'
+            '<a href="/posts/123"><img title="Permalink" alt="Permalink"></a>'
+            '<div class="post-content"><p>Text</p></div>'
+            "</div>"
+        )
+        assert rendered.permalink_fragment == ""
+        assert etree.tostring(rendered.html, encoding="unicode") == (
+            '<div class="post"><p><strong>Author</strong></p><p>Text</p></div>'
+        )